@@ -15,80 +15,75 @@ from smarts.sstudio.sstypes import (
     Via,
 )
 
+_VIAS = (
+    Via(
+        "edge-south-SN",
+        lane_offset=30,
+        lane_index=1,
+        required_speed=4,
+    ),
+    Via(
+        JunctionEdgeIDResolver("edge-south-SN", 1, "edge-west-EW", 0),
+        lane_offset=10,
+        lane_index=0,
+        required_speed=2,
+    ),
+    Via(
+        "edge-west-EW",
+        lane_offset=20,
+        lane_index=0,
+        required_speed=8,
+    ),
+    Via(
+        "edge-west-EW",
+        lane_offset=50,
+        lane_index=1,
+        required_speed=2,
+    ),
+    Via(
+        "edge-west-EW",
+        lane_offset=55,
+        lane_index=0,
+        required_speed=5,
+    ),
+    Via(
+        "edge-west-EW",
+        lane_offset=60,
+        lane_index=1,
+        required_speed=2,
+    ),
+    Via(
+        "edge-west-EW",
+        lane_offset=65,
+        lane_index=0,
+        required_speed=2,
+    ),
+    Via(
+        "edge-west-EW",
+        lane_offset=70,
+        lane_index=1,
+        required_speed=2,
+    ),
+)
+
 ego_missions = [
     Mission(
         route=Route(begin=("edge-south-SN", 1, 10), end=("edge-west-EW", 1, "max")),
     ),
-    EndlessMission(
-        begin=("edge-south-SN", 1, 10),
-        via=(
-            Via(
-                "edge-south-SN",
-                lane_offset=30,
-                lane_index=1,
-                required_speed=4,
-            ),
-            Via(
-                JunctionEdgeIDResolver("edge-south-SN", 1, "edge-west-EW", 0),
-                lane_offset=10,
-                lane_index=0,
-                required_speed=2,
-            ),
-            Via(
-                "edge-west-EW",
-                lane_offset=20,
-                lane_index=0,
-                required_speed=8,
-            ),
-            Via(
-                "edge-west-EW",
-                lane_offset=50,
-                lane_index=1,
-                required_speed=2,
-            ),
-            Via(
-                "edge-west-EW",
-                lane_offset=55,
-                lane_index=0,
-                required_speed=5,
-            ),
-            Via(
-                "edge-west-EW",
-                lane_offset=60,
-                lane_index=1,
-                required_speed=2,
-            ),
-            Via(
-                "edge-west-EW",
-                lane_offset=65,
-                lane_index=0,
-                required_speed=2,
-            ),
-            Via(
-                "edge-west-EW",
-                lane_offset=70,
-                lane_index=1,
-                required_speed=2,
-            ),
-        ),
-    ),
+    EndlessMission(begin=("edge-south-SN", 1, 10), via=_VIAS),
 ]
 
 variations = 40
+# `Flow` is frozen and random routes are resolved per traffic file with a derived
+# seed, so every variation can share the same flow instance.
+car_flow = Flow(
+    route=RandomRoute(),
+    rate=3600,
+    randomly_spaced=True,
+    actors={TrafficActor(name="car"): 1.0},
+)
 scenario = Scenario(
-    traffic={
-        f"t{i}": Traffic(
-            flows=[
-                Flow(
-                    route=RandomRoute(),
-                    rate=3600,
-                    randomly_spaced=True,
-                    actors={TrafficActor(name="car"): 1.0},
-                )
-            ]
-        )
-        for i in range(variations)
-    },
+    traffic={f"t{i}": Traffic(flows=[car_flow]) for i in range(variations)},
     ego_missions=ego_missions,
     map_spec=MapSpec(
         source=Path(__file__).parent.absolute(),
@@ -19,75 +19,249 @@
 # LIABILITY, WHETHER IN AN ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM,
 # OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 # THE SOFTWARE.
+import ctypes
+import ctypes.util
+import fcntl
 import gc
 import logging
+import os
+import tempfile
+import warnings
+from contextlib import contextmanager
+from pathlib import Path
 
 import gymnasium as gym
 import numpy as np
+import psutil
 import pytest
-from pympler import muppy, summary, tracker
 
 from smarts.core.agent import Agent
 from smarts.core.agent_interface import AgentInterface, AgentType
+from smarts.core.utils.file import file_md5_hash, path2hash, pickle_hash
 from smarts.zoo.agent_spec import AgentSpec
 
-SMARTS_MEMORY_GROWTH_LIMIT = 2e5
-EPISODE_MEMORY_GROWTH_LIMIT = 8e5
+# Limits are resident set size (RSS) growth in bytes, which includes native allocations
+# (SUMO, Panda3D, numpy buffers). Observed on Linux with Python 3.11 and glibc:
+#  - 100 episodes of 10 steps: Buddha 0.6 MB, Laner 0.3 MB, Tracker 0.3 MB,
+#    Full 180 MB (steady native growth of ~1.7 MB per reset).
+#  - 10 episodes of 100 steps per check: Buddha 0-2.3 MB, Laner 0-1.6 MB,
+#    Tracker 0-0.3 MB, Full 16-18 MB.
+#  - 10 env make/close cycles: 8 KB.
+# A steady leak above ~160 KB per episode fails the 100 episode runs and one above
+# ~800 KB per episode fails the periodic episode check, so the Full cases are expected
+# to fail until its native growth is fixed.
+SMARTS_MEMORY_GROWTH_LIMIT = 1.6e7
+EPISODE_MEMORY_GROWTH_LIMIT = 8e6
 TIMESTEP_SEC = 0.1
+DEFAULT_MAX_EPISODE_STEPS = 10
+ENV_CYCLE_COUNT = 10
+# Defer cyclic collection to episode boundaries instead of during steps
+GC_DEFER = os.environ.get("SMARTS_GC_DEFER") == "1"
 # Disable logging because it causes memory growth
 logging.disable(logging.WARNING)
 
 
-@pytest.fixture
+# One-shot, later collections (including the forced ones in `_strict_gc`) would only
+# repeat the warning with a different count
+def _warn_gc_cycles(phase, info):
+    if phase == "stop" and info["generation"] == 2 and info["collected"] > 0:
+        gc.callbacks.remove(_warn_gc_cycles)
+        warnings.warn(
+            f"Cyclic garbage collection freed {info['collected']} objects, "
+            "some objects were kept alive by reference cycles."
+        )
+
+
+if (
+    os.environ.get("SMARTS_WARN_GC_CYCLES") == "1"
+    and _warn_gc_cycles not in gc.callbacks
+):
+    gc.callbacks.append(_warn_gc_cycles)
+
+
+# Fully collect on both sides of the measured region. The second collection releases
+# objects resurrected by finalizers.
+@contextmanager
+def _strict_gc():
+    gc.collect(2)
+    gc.collect(2)
+    try:
+        yield
+    finally:
+        gc.collect(2)
+        gc.collect(2)
+
+
+def _load_malloc_trim():
+    try:
+        return ctypes.CDLL(ctypes.util.find_library("c")).malloc_trim
+    except (OSError, AttributeError):
+        # Not glibc
+        return None
+
+
+# Freed heap can stay mapped until a later allocation reuses it, which showed up as
+# ~20 MB of RSS appearing and disappearing between identical runs. Release it to the
+# OS before sampling so only memory that is still in use is measured.
+_MALLOC_TRIM = _load_malloc_trim()
+
+
+def _measure_rss():
+    if _MALLOC_TRIM is not None:
+        _MALLOC_TRIM(0)
+    # Query the current process each time since tests may run in a forked worker
+    return psutil.Process().memory_info().rss
+
+
+# Diagnostic tools are only imported once a check fails so they stay out of the
+# measured baseline. With `rerun` the growth of a repeated buildup is reported,
+# otherwise a summary of the live objects.
+def _lazy_diag(rerun=None):
+    import objgraph
+    from pympler import muppy, summary, tracker
+
+    if rerun is None:
+        summary.print_(summary.summarize(muppy.get_objects()), limit=30)
+        return
+
+    deep_diagnostic = os.environ.get("SMARTS_DEEP_LEAK_DIAG") == "1"
+    if deep_diagnostic:
+        tr = tracker.SummaryTracker()
+    objgraph.show_growth(limit=30)
+    rerun()
+    objgraph.show_growth(limit=30)
+    if deep_diagnostic:
+        summary.print_(tr.diff())
+    gc.collect()
+
+
+def _frozen_array(*args, **kwargs):
+    array = np.asarray(*args, **kwargs)
+    array.setflags(write=False)
+    return array
+
+
+# Actions are returned unchanged every step so they are built once and made read-only
+_TRACKER_ACTION = (
+    _frozen_array([1, 2] * 10),
+    _frozen_array([1, 2] * 10),
+    _frozen_array([0.5, 1] * 10),
+    _frozen_array([20, 20] * 10),
+)
+
+
+_FULL_NATIVE_LEAK = pytest.mark.xfail(
+    strict=True,
+    raises=AssertionError,
+    reason="AgentType.Full grows native memory by ~1.7 MB per reset",
+)
+
+
+# Each agent type runs its own SMARTS instance, so `--dist=loadgroup` can spread the
+# agent types across `pytest-xdist` workers.
+def _grouped_params(episodes, action, agent_type, marks=()):
+    return pytest.param(
+        (episodes, action, agent_type),
+        marks=[pytest.mark.xdist_group(name=f"smarts_{agent_type.name}"), *marks],
+    )
+
+
+@pytest.fixture(scope="session")
 def agent_id():
     return "Agent-006"
 
 
-@pytest.fixture
-def primative_scenarios():
-    return ["scenarios/sumo/intersections/2lane"]
+# Files a scenario build reads, hashed into a stamp written after a successful build
+_SCENARIO_BUILD_INPUTS = ("scenario.py", "map.net.xml")
+_SCENARIO_BUILD_STAMP = Path("build") / ".memory_test_build_hash"
 
 
-@pytest.fixture
-def social_agent_scenarios():
-    return [
-        "scenarios/sumo/intersections/4lane",
-        # "scenarios/sumo/intersections/6lane",
-    ]
+def _scenario_build_hash(scenario):
+    scenario_root = Path(scenario)
+    return pickle_hash(
+        tuple(
+            file_md5_hash(str(scenario_root / input_name))
+            for input_name in _SCENARIO_BUILD_INPUTS
+        ),
+        True,
+    )
+
+
+def _scenario_needs_build(scenario, build_hash):
+    scenario_root = Path(scenario)
+    if not (scenario_root / "build" / "build.db").exists():
+        return True
+    try:
+        return (scenario_root / _SCENARIO_BUILD_STAMP).read_text() != build_hash
+    except FileNotFoundError:
+        return True
+
+
+@pytest.fixture(scope="session")
+def built_scenarios():
+    from smarts.sstudio.scenario_construction import build_scenario
+
+    scenarios = {
+        "primative": ["scenarios/sumo/intersections/2lane"],
+        "social_agent": [
+            "scenarios/sumo/intersections/4lane",
+            # "scenarios/sumo/intersections/6lane",
+        ],
+    }
+    for scenario in (s for group in scenarios.values() for s in group):
+        # Each `pytest-xdist` worker has its own session, so serialize the builds
+        lock_path = os.path.join(
+            tempfile.gettempdir(),
+            f"smarts-build-{path2hash(os.path.abspath(scenario))}.lock",
+        )
+        with open(lock_path, "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            build_hash = _scenario_build_hash(scenario)
+            if _scenario_needs_build(scenario, build_hash):
+                build_scenario(scenario)
+                (Path(scenario) / _SCENARIO_BUILD_STAMP).write_text(build_hash)
+    return scenarios
+
 
+@pytest.fixture(scope="session")
+def primative_scenarios(built_scenarios):
+    return built_scenarios["primative"]
 
-@pytest.fixture
+
+@pytest.fixture(scope="session")
+def social_agent_scenarios(built_scenarios):
+    return built_scenarios["social_agent"]
+
+
+@pytest.fixture(scope="session")
 def seed():
     return 42
 
 
+@pytest.fixture(autouse=True)
+def unfreeze_gc():
+    # Tests freeze the warmed up objects out of collection, release them afterwards
+    yield
+    gc.unfreeze()
+
+
 @pytest.fixture(
     params=[
         # ( episodes, action, agent_type )
-        (100, (), AgentType.Buddha),
-        (100, np.array((1, 1, -1), dtype=np.float32), AgentType.Full),
+        _grouped_params(100, (), AgentType.Buddha),
+        _grouped_params(
+            100,
+            np.array((1, 1, -1), dtype=np.float32),
+            AgentType.Full,
+            marks=[_FULL_NATIVE_LEAK],
+        ),
         # (10, (30, 1, -1), AgentType.Standard),  # standard is just full but less
-        (100, 2, AgentType.Laner),
+        _grouped_params(100, 2, AgentType.Laner),
         # (100, (30, 1, -1), AgentType.Loner),
         # (100, (30, 1, -1), AgentType.Tagger),
         # (100, (30, 1, -1), AgentType.StandardWithAbsoluteSteering),
         # (100, (50, 0), AgentType.LanerWithSpeed),
-        (
-            100,
-            (
-                np.array(
-                    [
-                        1,
-                        2,
-                    ]
-                    * 10
-                ),
-                np.array([1, 2] * 10),
-                np.array([0.5, 1] * 10),
-                np.array([20, 20] * 10),
-            ),
-            AgentType.Tracker,
-        ),
+        _grouped_params(100, _TRACKER_ACTION, AgentType.Tracker),
         # ( 5, ([0,1,2], [0,1,2], [0,1,2]), AgentType.MPCTracker),
     ]
 )
@@ -95,9 +269,9 @@ def agent_params(request):
     return request.param
 
 
-@pytest.fixture
+@pytest.fixture(scope="session")
 def agent_type():
-    return (np.array((1, 1, -1), dtype=np.float32), AgentType.Full)
+    return (_frozen_array((1, 1, -1), dtype=np.float32), AgentType.Full)
 
 
 def env_and_spec(
@@ -126,7 +300,12 @@ def env_and_spec(
 
 
 def _env_memory_buildup(
-    agent_id, seed, scenarios, action, agent_type, max_episode_steps=10
+    agent_id,
+    seed,
+    scenarios,
+    action,
+    agent_type,
+    max_episode_steps=DEFAULT_MAX_EPISODE_STEPS,
 ):
     env, _ = env_and_spec(
         action, agent_type, max_episode_steps, scenarios, seed, agent_id
@@ -135,52 +314,40 @@ def _env_memory_buildup(
     gc.collect()
 
 
-def _every_nth_episode(agent_id, episode_count, env_and_spec, episodes_per_yield):
-    env, agent_spec = env_and_spec
+def _run_episodes(env, agent_id, episode_count, action):
+    # The policy ignores observations and always returns `action`, so step with the
+    # action directly rather than building and calling an agent every step.
+    # The environment does not keep the actions dict, so it is reused for every step
+    step_actions = {agent_id: action}
 
-    for episode_index in range(episode_count):
-        agent = agent_spec.build_agent()
-        observations, _ = env.reset()
+    for _ in range(episode_count):
+        env.reset()
 
         terminateds = {"__all__": False}
-        while not terminateds["__all__"]:
-            agent_obs = observations[agent_id]
-            agent_action = agent.act(agent_obs)
-            observations, rewards, terminateds, truncateds, infos = env.step(
-                {agent_id: agent_action}
-            )
-        agent_obs = None
-        agent_action = None
-        observations, rewards, terminateds, truncateds, infos = (
-            None,
-            None,
-            None,
-            None,
-            None,
-        )
-        if episode_index % episodes_per_yield == 0:
-            yield episode_index
+        if GC_DEFER:
+            gc.disable()
+        try:
+            while not terminateds["__all__"]:
+                _, _, terminateds, _, _ = env.step(step_actions)
+        finally:
+            if GC_DEFER:
+                gc.enable()
+                gc.collect(2)
 
 
 def _memory_buildup(
-    agent_id, seed, scenarios, episode_count, action, agent_type, max_episode_steps=10
+    agent_id,
+    seed,
+    scenarios,
+    episode_count,
+    action,
+    agent_type,
+    max_episode_steps=DEFAULT_MAX_EPISODE_STEPS,
 ):
-    env, agent_spec = env_and_spec(
+    env, _ = env_and_spec(
         action, agent_type, max_episode_steps, scenarios, seed, agent_id
     )
-
-    for _ in range(episode_count):
-        agent = agent_spec.build_agent()
-        observations, _ = env.reset()
-
-        terminateds = {"__all__": False}
-        while not terminateds["__all__"]:
-            agent_obs = observations[agent_id]
-            agent_action = agent.act(agent_obs)
-            observations, _, terminateds, truncateds, _ = env.step(
-                {agent_id: agent_action}
-            )
-
+    _run_episodes(env, agent_id, episode_count, action)
     env.close()
 
 
@@ -189,26 +356,25 @@ def test_env_memory_cleanup(agent_id, seed, primative_scenarios):
     _, action, agent_type = (100, None, AgentType.Buddha)
     _env_memory_buildup(agent_id, seed, primative_scenarios, action, agent_type)
     gc.collect()
+    gc.freeze()
 
-    # Memory size check
-    size = muppy.get_size(muppy.get_objects())
-    gc.collect()
-    _env_memory_buildup(agent_id, seed, primative_scenarios, action, agent_type)
-    end_size = muppy.get_size(muppy.get_objects())
-    gc.collect()
+    # Memory size check over repeated make/close cycles
+    size = _measure_rss()
+    with _strict_gc():
+        for _ in range(ENV_CYCLE_COUNT):
+            _env_memory_buildup(agent_id, seed, primative_scenarios, action, agent_type)
+    end_size = _measure_rss()
 
     def success_condition():
         return end_size - size < EPISODE_MEMORY_GROWTH_LIMIT
 
     if not success_condition():
         # Get a diff for failure case
-        tr = tracker.SummaryTracker()
-        tr.print_diff()
-        _env_memory_buildup(agent_id, seed, primative_scenarios, action, agent_type)
-        diff = tr.diff()
-        summary.print_(diff)
-        diff = None
-        gc.collect()
+        _lazy_diag(
+            lambda: _env_memory_buildup(
+                agent_id, seed, primative_scenarios, action, agent_type
+            )
+        )
         assert success_condition(), f"Size diff {end_size - size}"
 
 
@@ -221,35 +387,46 @@ def test_smarts_episode_memory_cleanup(
 
     _, action, agent_type = agent_params
 
-    env_and_agent_spec = env_and_spec(
+    env, agent_spec = env_and_spec(
         action, agent_type, MAX_EPISODE_STEPS, primative_scenarios, seed, agent_id
     )
 
-    size = 0
-    last_size = 0
-    gc.collect()
-    from pympler import refbrowser
-
-    tr = tracker.SummaryTracker()
+    last_size = None
+    step_actions = {agent_id: None}
     try:
-        for current_episode in _every_nth_episode(
-            agent_id,
-            EPISODE_COUNT,
-            env_and_agent_spec,
-            episodes_per_yield=EPISODES_PER_CHECK,
-        ):
-            gc.collect()
-            all_objects = muppy.get_objects()
-            size = muppy.get_size(all_objects)
-            tr.print_diff(summary.summarize(all_objects))
-            print(flush=True)
-            all_objects = None
+        for current_episode in range(EPISODE_COUNT):
+            agent = agent_spec.build_agent()
+            observations, _ = env.reset()
+
+            terminateds = {"__all__": False}
+            while not terminateds["__all__"]:
+                agent_obs = observations[agent_id]
+                step_actions[agent_id] = agent.act(agent_obs)
+                observations, rewards, terminateds, truncateds, infos = env.step(
+                    step_actions
+                )
+                del agent_obs
+            step_actions[agent_id] = None
+            del observations, rewards, terminateds, truncateds, infos, agent
+
+            if current_episode % EPISODES_PER_CHECK != 0:
+                continue
+
+            gc.collect(2)
+            size = _measure_rss()
+            if last_size is None:
+                # The first episode carries start up cost such as renderer and map
+                # loading, so it only sets the baseline.
+                last_size = size
+                continue
+            if size - last_size >= EPISODE_MEMORY_GROWTH_LIMIT:
+                _lazy_diag()
             assert (
                 size - last_size < EPISODE_MEMORY_GROWTH_LIMIT
             ), f"End size delta `{size - last_size=}` at `{current_episode=}`"
             last_size = size
     finally:
-        env_and_agent_spec[0].close()
+        env.close()
 
 
 def test_smarts_basic_memory_cleanup(agent_id, seed, primative_scenarios, agent_params):
@@ -259,30 +436,52 @@ def test_smarts_basic_memory_cleanup(agent_id, seed, primative_scenarios, agent_
     )
 
     gc.collect()
-    initial_size = muppy.get_size(muppy.get_objects())
+    gc.freeze()
+    initial_size = _measure_rss()
 
-    _memory_buildup(agent_id, seed, primative_scenarios, *agent_params)
-    end_size = muppy.get_size(muppy.get_objects())
+    with _strict_gc():
+        _memory_buildup(agent_id, seed, primative_scenarios, *agent_params)
+    end_size = _measure_rss()
     # Check for a major leak
     assert (
         end_size - initial_size < SMARTS_MEMORY_GROWTH_LIMIT
     ), f"End size delta {end_size - initial_size}"
 
 
-def test_smarts_repeated_runs_memory_cleanup(
+@_FULL_NATIVE_LEAK
+def test_smarts_repeated_resets_memory_cleanup(
     agent_id, seed, primative_scenarios, agent_type
 ):
     # Run once to initialize globals and test to see if smarts is working
     _memory_buildup(agent_id, seed, primative_scenarios, 1, *agent_type)
 
+    # Reuse a single environment across the repeated resets
+    action, agent_type = agent_type
+    env, _ = env_and_spec(
+        action,
+        agent_type,
+        DEFAULT_MAX_EPISODE_STEPS,
+        primative_scenarios,
+        seed,
+        agent_id,
+    )
+    # Freeze before the warm up episode so its state stays collectable when the first
+    # measured reset tears it down
     gc.collect()
-    initial_size = muppy.get_size(muppy.get_objects())
+    gc.freeze()
+    try:
+        _run_episodes(env, agent_id, 1, action)
 
-    for i in range(100):
-        _memory_buildup(agent_id, seed, primative_scenarios, 1, *agent_type)
+        gc.collect()
+        initial_size = _measure_rss()
 
-    gc.collect()
-    end_size = muppy.get_size(muppy.get_objects())
+        with _strict_gc():
+            for _ in range(100):
+                _run_episodes(env, agent_id, 1, action)
+
+        end_size = _measure_rss()
+    finally:
+        env.close()
 
     # This "should" be roughly the same as `test_smarts_basic_memory_cleanup`
     assert (
@@ -295,25 +494,25 @@ def test_smarts_fast_reset_memory_cleanup(agent_id, seed, social_agent_scenarios
     # Run once to initialize globals and test to see if smarts is working
     _memory_buildup(agent_id, seed, social_agent_scenarios, 1, None, agent_type)
 
-    tr = tracker.SummaryTracker()
     gc.collect()
-    initial_size = muppy.get_size(muppy.get_objects())
-
-    for _ in range(100):
-        _memory_buildup(
-            agent_id,
-            seed,
-            social_agent_scenarios,
-            1,
-            (),
-            agent_type,
-            max_episode_steps=2,
-        )
+    gc.freeze()
+    initial_size = _measure_rss()
+
+    with _strict_gc():
+        for _ in range(100):
+            _memory_buildup(
+                agent_id,
+                seed,
+                social_agent_scenarios,
+                1,
+                (),
+                agent_type,
+                max_episode_steps=2,
+            )
 
-    gc.collect()
-    end_size = muppy.get_size(muppy.get_objects())
-    gc.collect()
-    tr.print_diff()
+    end_size = _measure_rss()
+    if end_size - initial_size >= SMARTS_MEMORY_GROWTH_LIMIT:
+        _lazy_diag()
 
     # Check for a major leak
     assert (
@@ -321,6 +520,7 @@ def test_smarts_fast_reset_memory_cleanup(agent_id, seed, social_agent_scenarios
     ), f"End size delta {end_size - initial_size}"
 
 
+@_FULL_NATIVE_LEAK
 def test_smarts_social_agent_scenario_memory_cleanup(
     agent_id, seed, social_agent_scenarios, agent_type
 ):
@@ -330,12 +530,13 @@ def test_smarts_social_agent_scenario_memory_cleanup(
     )
 
     gc.collect()
-    initial_size = muppy.get_size(muppy.get_objects())
+    gc.freeze()
+    initial_size = _measure_rss()
 
-    _memory_buildup(agent_id, seed, social_agent_scenarios, 100, *agent_type)
+    with _strict_gc():
+        _memory_buildup(agent_id, seed, social_agent_scenarios, 100, *agent_type)
 
-    gc.collect()
-    end_size = muppy.get_size(muppy.get_objects())
+    end_size = _measure_rss()
 
     assert (
         end_size - initial_size < SMARTS_MEMORY_GROWTH_LIMIT